@@ -2,16 +2,35 @@
 # Final corrected version, fixing the NameError in the AI function.
 
 import os
+import sys
+import time
+import asyncio
+import random
+import hashlib
 import logging
-import threading
-import smtplib
-from email.message import EmailMessage
-from flask import Flask
+import signal
+import sqlite3
+from collections import deque
+from contextlib import aclosing
+from aiohttp import web
+from aiolimiter import AsyncLimiter
 
-import google.generativeai as genai
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, DictPersistence
-from telegram.constants import ParseMode
+from cachetools import TTLCache
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyParameters
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, PicklePersistence
+from telegram.constants import MessageLimit, ParseMode
+from telegram.error import RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
+
+try:
+    import uvloop
+except ImportError:  # Not available on Windows; fall back to the default asyncio loop.
+    uvloop = None
+
+try:
+    import sqlite_vec
+except ImportError:  # Optional; without it only the exact-match cache tier is used.
+    sqlite_vec = None
 
 # --- 1. CONFIGURATION & SETUP ---
 
@@ -19,7 +38,9 @@ logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", 
     level=logging.INFO
 )
-logging.getLogger("httpx").setLevel(logging.WARNING)
+# Retry storms make these libraries log a warning per request; only errors are worth the logging lock.
+logging.getLogger("httpx").setLevel(logging.ERROR)
+logging.getLogger("google").setLevel(logging.ERROR)
 logger = logging.getLogger(__name__)
 
 # Load all environment variables
@@ -29,31 +50,145 @@ PORT = int(os.environ.get('PORT', 8443))
 SENDER_EMAIL = os.getenv("SENDER_EMAIL")
 SENDER_APP_PASSWORD = os.getenv("SENDER_APP_PASSWORD")
 RECIPIENT_EMAIL = os.getenv("RECIPIENT_EMAIL")
+# Public base URL for the webhook. PUBLIC_URL wins; RENDER_EXTERNAL_HOSTNAME is set automatically by Render.
+RENDER_EXTERNAL_HOSTNAME = os.getenv("RENDER_EXTERNAL_HOSTNAME")
+PUBLIC_URL = os.getenv("PUBLIC_URL") or (f"https://{RENDER_EXTERNAL_HOSTNAME}" if RENDER_EXTERNAL_HOSTNAME else None)
+# `python bot.py --dev` forces long polling, e.g. for local runs with production variables set.
+DEV_MODE = "--dev" in sys.argv
 
-if not all([TELEGRAM_TOKEN, GEMINI_API_KEY, SENDER_EMAIL, SENDER_APP_PASSWORD, RECIPIENT_EMAIL]):
+TELEGRAM_POOL_SIZE = 256
+# A fixed path: the secret token header authenticates updates, and access logs never see the bot token.
+WEBHOOK_PATH = "/telegram"
+WEBHOOK_URL = f"{PUBLIC_URL.rstrip('/')}{WEBHOOK_PATH}" if PUBLIC_URL and not DEV_MODE else None
+
+if not all([TELEGRAM_TOKEN, GEMINI_API_KEY]):
     logger.critical("FATAL ERROR: One or more environment variables are not set.")
-    exit()
+    sys.exit(1)
 
-try:
-    genai.configure(api_key=GEMINI_API_KEY)
-except Exception as e:
-    logger.critical(f"FATAL ERROR: Failed to configure Gemini API: {e}")
-    exit()
+# Telegram echoes this back so forged updates can be rejected. It must be the same on every
+# instance, or an old instance still taking traffic during a deploy would reject real updates.
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{TELEGRAM_TOKEN}".encode()).hexdigest()
+
+# /mail is optional; without its credentials the email libraries are never imported.
+EMAIL_ENABLED = all([SENDER_EMAIL, SENDER_APP_PASSWORD, RECIPIENT_EMAIL])
+if not EMAIL_ENABLED:
+    logger.info("Email settings are not set; /mail is disabled.")
+
+# The /code preamble is sent once as the model's system instruction instead of
+# being prepended to every request body.
+CODE_SYSTEM_INSTRUCTION = (
+    "You are a Python code execution engine. "
+    "Execute the Python code you are given and return ONLY the standard output (stdout). "
+    "If there's an error, return ONLY the error message. Provide no explanation."
+)
+
+# google.generativeai pulls in grpc and google-auth, so it is imported on the first
+# Gemini call rather than at startup. Models are still built once and shared.
+_genai = None
+_MODELS = {}
+
+def get_genai():
+    """Imports and configures google.generativeai on first use."""
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai
+        genai.configure(api_key=GEMINI_API_KEY)
+        _genai = genai
+    return _genai
+
+async def load_genai():
+    """Returns google.generativeai, importing it in a worker thread the first time so the event loop never stalls."""
+    if _genai is None:
+        await asyncio.to_thread(get_genai)
+    return _genai
+
+def get_model(system_instruction=None):
+    """Returns the shared gemini-1.5-flash model for a system instruction, building it on first use."""
+    model = _MODELS.get(system_instruction)
+    if model is None:
+        model = get_genai().GenerativeModel('gemini-1.5-flash', system_instruction=system_instruction)
+        _MODELS[system_instruction] = model
+    return model
+
+
+# --- 2. WEB SERVER & EMAIL SENDER ---
 
+APPLICATION_KEY = web.AppKey("application", Application)
 
-# --- 2. FLASK WEB SERVER & EMAIL SENDER ---
+async def health_check(request):
+    return web.Response(text="OK")
 
-app = Flask(__name__)
+async def telegram_webhook(request):
+    """Receives an update pushed by Telegram and queues it for the bot."""
+    if request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    application = request.app[APPLICATION_KEY]
+    update = Update.de_json(await request.json(), application.bot)
+    await application.update_queue.put(update)
+    return web.Response()
 
-@app.route('/')
-def health_check():
-    return "OK", 200
+def build_web_app(application: Application) -> web.Application:
+    """Builds the aiohttp app serving the health check and, in webhook mode, Telegram updates."""
+    web_app = web.Application()
+    web_app[APPLICATION_KEY] = application
+    web_app.router.add_get('/', health_check)
+    if WEBHOOK_URL:
+        web_app.router.add_post(WEBHOOK_PATH, telegram_webhook)
+    return web_app
 
-def run_flask():
-    app.run(host='0.0.0.0', port=PORT)
+class SMTPPool:
+    """A small pool of logged-in Gmail SMTP connections reused across sends.
 
-def send_email(subject, body):
-    """Connects to Gmail and sends the email."""
+    Connections are opened on demand, up to `size` at once. A connection idle
+    for longer than `keepalive` seconds is probed with NOOP before reuse and
+    replaced if the server has dropped it.
+    """
+
+    def __init__(self, size: int = 4, keepalive: float = 30):
+        self._slots = asyncio.Semaphore(size)
+        self._idle = deque()
+        self._keepalive = keepalive
+
+    async def _connect(self):
+        import aiosmtplib
+        smtp = aiosmtplib.SMTP(hostname='smtp.gmail.com', port=465, use_tls=True)
+        await smtp.connect()
+        await smtp.login(SENDER_EMAIL, SENDER_APP_PASSWORD)
+        return smtp
+
+    async def _checkout(self):
+        import aiosmtplib
+        while self._idle:
+            smtp, last_used = self._idle.pop()
+            if time.monotonic() - last_used < self._keepalive:
+                return smtp
+            try:
+                await smtp.noop()
+                return smtp
+            except aiosmtplib.SMTPException:
+                smtp.close()
+        return await self._connect()
+
+    async def send_message(self, msg):
+        import aiosmtplib
+        async with self._slots:
+            smtp = await self._checkout()
+            try:
+                try:
+                    await smtp.send_message(msg)
+                except aiosmtplib.SMTPServerDisconnected:
+                    smtp = await self._connect()
+                    await smtp.send_message(msg)
+            except Exception:
+                smtp.close()
+                raise
+            self._idle.append((smtp, time.monotonic()))
+
+SMTP_POOL = SMTPPool()
+
+async def send_email(subject, body):
+    """Sends the email over a pooled Gmail connection without blocking the event loop."""
+    from email.message import EmailMessage
     try:
         msg = EmailMessage()
         msg.set_content(body)
@@ -61,122 +196,644 @@ def send_email(subject, body):
         msg['From'] = SENDER_EMAIL
         msg['To'] = RECIPIENT_EMAIL
 
-        with smtplib.SMTP_SSL('smtp.gmail.com', 465) as smtp:
-            smtp.login(SENDER_EMAIL, SENDER_APP_PASSWORD)
-            smtp.send_message(msg)
-        logger.info(f"Email sent successfully to {RECIPIENT_EMAIL}")
+        await SMTP_POOL.send_message(msg)
+        logger.info("Email sent successfully to %s", RECIPIENT_EMAIL)
         return True
     except Exception as e:
-        logger.error(f"Failed to send email: {e}")
+        logger.error("Failed to send email: %s", e)
         return False
 
 
 # --- 3. TELEGRAM BOT LOGIC ---
 
-async def generate_gemini_response(prompt: str) -> str:
-    """(FIXED) Sends a prompt to the Gemini API and returns the text response."""
+GEMINI_ERROR_REPLY = "Sorry, I'm having trouble connecting to my brain right now."
+# str.translate tables for MarkdownV2: every reserved character in regular text,
+# and the only two that must be escaped inside code/pre entities.
+MDV2_TABLE = str.maketrans({c: '\\' + c for c in r'\_*[]()~`>#+-=|{}.!'})
+MDV2_CODE_TABLE = str.maketrans({c: '\\' + c for c in '\\`'})
+WELCOME_TEMPLATE = (
+    "Hello, {name}! I am your AI assistant.\n\n"
+    "• `/code <python code>` - Executes Python code.\n"
+    "• `/mail <Subject>\n<Body>` - Drafts an email to send."
+)
+# MarkdownV2 preview of a /mail draft; every field must already be escaped.
+EMAIL_DRAFT_TEMPLATE = (
+    "Here is the email draft to be sent to `{recipient}`:\n\\-\\-\\-\n"
+    "*Subject:* {subject}\n\n*Dear Team,*\n\n{body}\n\n*Best regards,*\n{name}"
+)
+# Unsent email drafts older than this many seconds are discarded.
+EMAIL_DRAFT_TTL = 3600
+# Minimum seconds between edits of a streamed reply, to stay within Telegram's rate limits.
+STREAM_EDIT_INTERVAL = 1.0
+
+# Futures for Gemini requests currently in flight, keyed by inflight_key().
+INFLIGHT = {}
+
+def inflight_key(prompt: str, system_instruction=None):
+    return system_instruction, hashlib.sha1(prompt.encode()).hexdigest()
+
+async def coalesce_inflight(key, make_request):
+    """Awaits make_request() once per key; concurrent callers with the same key share its result.
+
+    Returns (result, shared), where shared is True for callers that reused another caller's request.
+    """
+    pending = INFLIGHT.get(key)
+    if pending is not None:
+        return await asyncio.shield(pending), True
+
+    future = INFLIGHT[key] = asyncio.get_running_loop().create_future()
+    try:
+        result = await make_request()
+        future.set_result(result)
+        return result, False
+    finally:
+        del INFLIGHT[key]
+        if not future.done():
+            future.set_result(GEMINI_ERROR_REPLY)
+
+# Caps on concurrent and per-minute Gemini requests, sized for the free tier's quota.
+GEMINI_SEMAPHORE = asyncio.Semaphore(4)
+GEMINI_LIMITER = AsyncLimiter(60, 60)
+GEMINI_MAX_RETRIES = 3
+
+async def call_gemini(system_instruction, prompt: str, **kwargs):
+    """Calls generate_content_async under the rate limit, retrying 429s with exponential backoff."""
+    await load_genai()
+    model = get_model(system_instruction)
+    from google.api_core.exceptions import ResourceExhausted
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        await GEMINI_LIMITER.acquire()
+        try:
+            return await model.generate_content_async(prompt, **kwargs)
+        except ResourceExhausted:
+            if attempt == GEMINI_MAX_RETRIES:
+                raise
+            delay = 2 ** attempt + random.random()
+            logger.warning("Gemini rate limit hit, retrying in %.1fs", delay)
+            await asyncio.sleep(delay)
+
+async def request_gemini_response(prompt: str, system_instruction=None) -> str:
+    """Sends a prompt to the Gemini API and returns the text response."""
     try:
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        # This line is now correct and calls the model, not itself.
-        response = await model.generate_content_async(prompt)
+        async with GEMINI_SEMAPHORE:
+            response = await call_gemini(system_instruction, prompt)
         return response.text
     except Exception as e:
-        logger.error(f"Error communicating with Gemini API: {e}")
-        return "Sorry, I'm having trouble connecting to my brain right now."
+        logger.error("Error communicating with Gemini API: %s", e)
+        return GEMINI_ERROR_REPLY
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_name = update.message.from_user.first_name
-    welcome_message = (
-        f"Hello, {user_name}! I am your AI assistant.\n\n"
-        "• `/code <python code>` - Executes Python code.\n"
-        "• `/mail <Subject>\n<Body>` - Drafts an email to send."
+async def generate_gemini_response(prompt: str, system_instruction=None) -> str:
+    """Returns Gemini's response to a prompt, sharing one API call between identical concurrent prompts."""
+    response, _ = await coalesce_inflight(
+        inflight_key(prompt, system_instruction), lambda: request_gemini_response(prompt, system_instruction)
     )
-    await update.message.reply_text(welcome_message)
+    return response
+
+async def stream_gemini_response(prompt: str, system_instruction=None):
+    """Yields the Gemini response text chunk by chunk as it is generated.
+
+    The stream is read by a background task into a buffer, so the Gemini slot is
+    released as soon as the response is complete, however slowly the caller consumes it.
+    """
+    chunks = asyncio.Queue()
+
+    async def read_stream():
+        try:
+            async with GEMINI_SEMAPHORE:
+                response = await call_gemini(system_instruction, prompt, stream=True)
+                async for chunk in response:
+                    chunks.put_nowait(chunk.text)
+        except Exception as e:
+            chunks.put_nowait(e)
+        else:
+            chunks.put_nowait(None)
+
+    reader = asyncio.create_task(read_stream())
+    try:
+        while (chunk := await chunks.get()) is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        reader.cancel()
+
+# Two-tier response cache: exact prompts by SHA-1, near-duplicates by embedding similarity.
+EXACT_CACHE_TTL = 600
+EXACT_CACHE_MAX_ENTRIES = 1024
+SEMANTIC_CACHE_TTL = 600
+SEMANTIC_CACHE_MAX_ENTRIES = 10_000
+EMBEDDING_MODEL = 'models/text-embedding-004'
+SEMANTIC_SIMILARITY_THRESHOLD = 0.92
+
+RESPONSE_CACHE = TTLCache(maxsize=EXACT_CACHE_MAX_ENTRIES, ttl=EXACT_CACHE_TTL)
+
+def exact_cache_key(prompt: str) -> str:
+    """Keys the exact-match tier on the prompt with case and surrounding whitespace ignored."""
+    return hashlib.sha1(prompt.strip().lower().encode()).hexdigest()
+
+def open_semantic_db():
+    """Opens the in-memory semantic cache, or returns None if sqlite-vec can't be loaded.
+
+    Many Python builds (pyenv, python.org macOS) ship sqlite3 without extension
+    loading; the bot then runs with the exact-match tier only.
+    """
+    if sqlite_vec is None:
+        logger.warning("sqlite-vec is not installed, the semantic cache is disabled.")
+        return None
+    try:
+        db = sqlite3.connect(':memory:')
+        db.enable_load_extension(True)
+        sqlite_vec.load(db)
+        db.enable_load_extension(False)
+    except (AttributeError, sqlite3.OperationalError) as e:
+        logger.warning("Could not load sqlite-vec, the semantic cache is disabled: %s", e)
+        return None
+    db.execute(
+        "CREATE TABLE semantic_cache "
+        "(chat_id INTEGER NOT NULL, embedding BLOB NOT NULL, response TEXT NOT NULL, created_at REAL NOT NULL)"
+    )
+    db.execute("CREATE INDEX semantic_cache_chat ON semantic_cache (chat_id, created_at)")
+    return db
+
+SEMANTIC_DB = open_semantic_db()
+
+class EmbeddingBatcher:
+    """Collects prompts for a short window and embeds them with a single batch request.
+
+    A batch is sent `window` seconds after its first prompt arrives, or as soon
+    as it holds `max_batch` prompts.
+    """
+
+    def __init__(self, window: float = 0.02, max_batch: int = 32):
+        self._window = window
+        self._max_batch = max_batch
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def embed(self, prompt: str):
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((prompt, future))
+        if len(self._pending) >= self._max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self._window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._embed_batch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _embed_batch(self, batch):
+        try:
+            genai = await load_genai()
+            result = await genai.embed_content_async(
+                model=EMBEDDING_MODEL, content=[prompt for prompt, _ in batch], task_type='semantic_similarity'
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), embedding in zip(batch, result['embedding']):
+                if not future.done():
+                    future.set_result(embedding)
+
+EMBEDDER = EmbeddingBatcher()
+
+async def embed_prompt(prompt: str):
+    """Returns the embedding vector for a prompt, or None if it couldn't be computed."""
+    try:
+        return await EMBEDDER.embed(prompt)
+    except Exception as e:
+        logger.warning("Failed to embed prompt for the semantic cache: %s", e)
+        return None
+
+def semantic_has_live_rows(chat_id: int) -> bool:
+    """Returns whether the chat has any unexpired semantic cache entries to match against."""
+    return SEMANTIC_DB.execute(
+        "SELECT 1 FROM semantic_cache WHERE chat_id = ? AND created_at > ? LIMIT 1",
+        (chat_id, time.time() - SEMANTIC_CACHE_TTL)
+    ).fetchone() is not None
+
+def semantic_lookup(embedding, chat_id: int):
+    """Returns the chat's cached response closest to the embedding if it is similar enough."""
+    row = SEMANTIC_DB.execute(
+        "SELECT response, vec_distance_cosine(embedding, ?) AS distance FROM semantic_cache "
+        "WHERE chat_id = ? AND created_at > ? ORDER BY distance LIMIT 1",
+        (sqlite_vec.serialize_float32(embedding), chat_id, time.time() - SEMANTIC_CACHE_TTL)
+    ).fetchone()
+    if row and row[1] <= 1 - SEMANTIC_SIMILARITY_THRESHOLD:
+        return row[0]
+    return None
+
+def semantic_store(embedding, response, chat_id: int):
+    """Stores a response under its prompt embedding, dropping expired and excess rows."""
+    if SEMANTIC_DB is None:
+        return
+    now = time.time()
+    with SEMANTIC_DB:
+        SEMANTIC_DB.execute("DELETE FROM semantic_cache WHERE created_at <= ?", (now - SEMANTIC_CACHE_TTL,))
+        SEMANTIC_DB.execute(
+            "INSERT INTO semantic_cache (chat_id, embedding, response, created_at) VALUES (?, ?, ?, ?)",
+            (chat_id, sqlite_vec.serialize_float32(embedding), response, now)
+        )
+        SEMANTIC_DB.execute(
+            "DELETE FROM semantic_cache WHERE rowid NOT IN "
+            "(SELECT rowid FROM semantic_cache ORDER BY created_at DESC LIMIT ?)",
+            (SEMANTIC_CACHE_MAX_ENTRIES,)
+        )
+
+def exact_cache_get(prompt: str):
+    """Returns the exact-match cached response for a prompt, or None."""
+    return RESPONSE_CACHE.get(exact_cache_key(prompt))
+
+async def cache_lookup(prompt: str, chat_id: int):
+    """Returns (cached response or None, task for the prompt embedding or None) for a prompt sent in a chat.
+
+    Semantic matches are scoped to the chat, so paraphrase hits never surface
+    another chat's conversation. A chat with nothing cached can't produce a hit,
+    so its embedding is left computing alongside the Gemini call, for cache_store.
+    """
+    response = exact_cache_get(prompt)
+    if response is not None or SEMANTIC_DB is None:
+        return response, None
+
+    embedding = asyncio.create_task(embed_prompt(prompt))
+    if semantic_has_live_rows(chat_id):
+        vector = await embedding
+        if vector is not None:
+            response = semantic_lookup(vector, chat_id)
+    return response, embedding
+
+def cache_store(prompt: str, response: str, chat_id: int, embedding=None):
+    """Populates both cache tiers with a fresh Gemini response."""
+    RESPONSE_CACHE[exact_cache_key(prompt)] = response
+    if embedding is not None:
+        semantic_store(embedding, response, chat_id)
+
+# Per-chat send state is kept for this many chats at most.
+CHAT_STATE_MAX_ENTRIES = 10_000
+# A chat's limiter is dropped once unused for this long; by then its bucket has fully
+# drained, so a fresh limiter paces the chat exactly as the old one would have.
+CHAT_LIMITER_TTL = 120
+
+class SendQueue:
+    """Per-chat outbound message queues drained within Telegram's rate limits.
+
+    Each chat with pending messages gets one drain task, which exits once its
+    queue is empty. Sends are paced to about one per second in a private chat
+    and 20 per minute in a group, so a quiet chat is answered immediately.
+    Plain-text messages that pile up while a chat is waiting for a send slot
+    are joined into a single sendMessage call. In groups, replies quote the
+    message they answer, as Message.reply_text does, and only replies to the
+    same message are joined.
+    """
+
+    def __init__(self):
+        self._queues = {}
+        self._workers = {}
+        self._global_limiter = AsyncLimiter(30, 1)
+        self._chat_limiters = TTLCache(maxsize=CHAT_STATE_MAX_ENTRIES, ttl=CHAT_LIMITER_TTL)
+
+    async def send(self, bot, chat_id: int, text: str, reply_to: int = None, coalesce: bool = True, **kwargs):
+        """Queues a message for a chat and returns the sent Message once delivered.
+
+        reply_to is the id of the message being answered. Pass coalesce=False
+        for messages that will be edited later, so they are never merged with
+        unrelated text.
+        """
+        future = asyncio.get_running_loop().create_future()
+        mergeable = coalesce and not kwargs
+        # Negative chat ids are groups and channels; private chats don't quote.
+        reply_to = reply_to if chat_id < 0 else None
+        self._queues.setdefault(chat_id, deque()).append((text, reply_to, kwargs, mergeable, future))
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(bot, chat_id))
+        return await future
+
+    async def _drain(self, bot, chat_id: int):
+        queue = self._queues[chat_id]
+        try:
+            while queue:
+                text, reply_to, kwargs, mergeable, future = queue.popleft()
+                futures = [future]
+                await self._chat_limiter(chat_id).acquire()
+                await self._global_limiter.acquire()
+                # Anything queued meanwhile is coalesced, as long as it stays within one message.
+                while mergeable and queue and queue[0][3] and queue[0][1] == reply_to and \
+                        len(text) + 1 + len(queue[0][0]) <= MessageLimit.MAX_TEXT_LENGTH:
+                    next_text, _, _, _, next_future = queue.popleft()
+                    text = f"{text}\n{next_text}"
+                    futures.append(next_future)
+                if reply_to is not None:
+                    kwargs = dict(kwargs, reply_parameters=ReplyParameters(reply_to, allow_sending_without_reply=True))
+                try:
+                    message = await self._send(bot, chat_id, text, kwargs)
+                except Exception as e:
+                    for f in futures:
+                        if not f.done():
+                            f.set_exception(e)
+                else:
+                    for f in futures:
+                        if not f.done():
+                            f.set_result(message)
+        finally:
+            del self._workers[chat_id]
+            del self._queues[chat_id]
+
+    def _chat_limiter(self, chat_id: int) -> AsyncLimiter:
+        limiter = self._chat_limiters.get(chat_id)
+        if limiter is None:
+            # Negative chat ids are groups and channels.
+            limiter = AsyncLimiter(20, 60) if chat_id < 0 else AsyncLimiter(1, 1)
+        # Re-inserting restarts the entry's TTL, so only idle chats expire.
+        self._chat_limiters[chat_id] = limiter
+        return limiter
+
+    async def _send(self, bot, chat_id: int, text: str, kwargs: dict):
+        try:
+            return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+        except RetryAfter as e:
+            # Flood control: wait out the delay Telegram asks for instead of failing the reply.
+            logger.warning("Flood limit hit in chat %s, retrying in %ss", chat_id, e.retry_after)
+            await asyncio.sleep(e.retry_after)
+            return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+
+SEND_QUEUE = SendQueue()
+
+# Telegram shows "typing" for about 5 seconds after each chat action.
+TYPING_DEBOUNCE = 4.0
+# Chats that showed a typing indicator within the last TYPING_DEBOUNCE seconds.
+LAST_TYPING = TTLCache(maxsize=CHAT_STATE_MAX_ENTRIES, ttl=TYPING_DEBOUNCE)
+
+def send_typing(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    """Starts a typing indicator in the background unless the chat already shows one.
+
+    The indicator is cosmetic, so it runs alongside the Gemini call rather than before it.
+    Returns the task, or None if the action was skipped.
+    """
+    if chat_id in LAST_TYPING:
+        return None
+    LAST_TYPING[chat_id] = True
+    return context.application.create_task(context.bot.send_chat_action(chat_id=chat_id, action='typing'))
+
+def command_payload(message) -> str:
+    """Returns the raw text after a command.
+
+    Unlike joining context.args, this keeps the newlines and indentation the user typed.
+    """
+    parts = (message.text or "").split(maxsplit=1)
+    return parts[1] if len(parts) > 1 else ""
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    welcome_message = WELCOME_TEMPLATE.format(name=update.message.from_user.first_name)
+    await SEND_QUEUE.send(context.bot, update.effective_chat.id, welcome_message, update.message.message_id)
 
 async def code_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
-        await update.message.reply_text("Usage: /code <python code snippet to execute>")
+        await SEND_QUEUE.send(
+            context.bot, update.effective_chat.id, "Usage: /code <python code snippet to execute>", update.message.message_id
+        )
         return
-    user_code = " ".join(context.args)
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action='typing')
-    execution_prompt = (
-        "You are a Python code execution engine. "
-        "Execute the following Python code and return ONLY the standard output (stdout). "
-        "If there's an error, return ONLY the error message. Provide no explanation."
-        f"\n\nCode:\n```python\n{user_code}\n```"
+    user_code = command_payload(update.message)
+    # The typing indicator is cosmetic and left unawaited; create_task already reports its errors.
+    send_typing(context, update.effective_chat.id)
+    # Code prompts bypass the response cache: they must never be semantically merged.
+    output = await generate_gemini_response(f"```python\n{user_code}\n```", system_instruction=CODE_SYSTEM_INSTRUCTION)
+    await SEND_QUEUE.send(
+        context.bot, update.effective_chat.id, f"Output:\n```\n{output.translate(MDV2_CODE_TABLE)}\n```",
+        update.message.message_id, parse_mode=ParseMode.MARKDOWN_V2
     )
-    output = await generate_gemini_response(execution_prompt)
-    await update.message.reply_text(f"Output:\n```\n{output}\n```", parse_mode=ParseMode.MARKDOWN_V2)
+
+def store_email_draft(user_data: dict, subject: str, body: str):
+    """Saves a pending email draft along with when it was written, for prune_email_drafts."""
+    user_data['email_draft'] = {'subject': subject, 'body': body}
+    user_data['email_draft_ts'] = time.time()
+
+async def prune_email_drafts(context: ContextTypes.DEFAULT_TYPE):
+    """Drops email drafts that were never sent within EMAIL_DRAFT_TTL seconds."""
+    cutoff = time.time() - EMAIL_DRAFT_TTL
+    pruned = []
+    for user_id, user_data in context.application.user_data.items():
+        if user_data.get('email_draft_ts', cutoff) < cutoff:
+            user_data.pop('email_draft', None)
+            user_data.pop('email_draft_ts', None)
+            pruned.append(user_id)
+    # Persistence only saves users touched by an update; flag these so bot_state forgets the drafts too.
+    if pruned:
+        context.application.mark_data_for_update_persistence(user_ids=pruned)
 
 async def mail_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
-        await update.message.reply_text("Usage: /mail <Subject Line>\n<Body of the email...>")
+        await SEND_QUEUE.send(
+            context.bot, update.effective_chat.id, "Usage: /mail <Subject Line>\n<Body of the email...>", update.message.message_id
+        )
+        return
+    if not EMAIL_ENABLED:
+        await SEND_QUEUE.send(context.bot, update.effective_chat.id, "Email is not configured for this bot.", update.message.message_id)
         return
         
-    content = " ".join(context.args)
-    try:
-        subject, body = content.split('\n', 1)
-    except ValueError:
-        subject = content
+    subject, _, body = command_payload(update.message).partition('\n')
+    if not body:
         body = "[No body provided]"
 
-    context.user_data['email_draft'] = {'subject': subject, 'body': body}
-    user_name = update.message.from_user.first_name
-    email_template = f"*Subject:* {subject}\n\n*Dear Team,*\n\n{body}\n\n*Best regards,*\n{user_name}"
+    store_email_draft(context.user_data, subject, body)
+    email_draft = EMAIL_DRAFT_TEMPLATE.format(
+        recipient=RECIPIENT_EMAIL.translate(MDV2_CODE_TABLE),
+        subject=subject.translate(MDV2_TABLE),
+        body=body.translate(MDV2_TABLE),
+        name=update.message.from_user.first_name.translate(MDV2_TABLE)
+    )
     
     keyboard = [[InlineKeyboardButton("Send Email", callback_data='send_email_confirm')]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await update.message.reply_text(
-        f"Here is the email draft to be sent to `{RECIPIENT_EMAIL}`:\n---\n{email_template}", 
+    await SEND_QUEUE.send(
+        context.bot, update.effective_chat.id, email_draft, update.message.message_id,
         parse_mode=ParseMode.MARKDOWN_V2,
         reply_markup=reply_markup
     )
 
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
 
     if query.data == 'send_email_confirm':
-        draft = context.user_data.get('email_draft')
+        # Claimed before sending: updates run concurrently, so a second tap must find no draft.
+        draft = context.user_data.pop('email_draft', None)
+        draft_ts = context.user_data.pop('email_draft_ts', 0)
         if not draft:
+            await query.answer()
             await query.edit_message_text(text="Sorry, I couldn't find the email draft. Please try again.")
             return
+        # prune_email_drafts only runs every few minutes, so expired drafts are also rejected here.
+        if draft_ts < time.time() - EMAIL_DRAFT_TTL:
+            await query.answer()
+            await query.edit_message_text(text="Sorry, this email draft has expired. Please use /mail again.")
+            return
 
-        success = send_email(draft['subject'], draft['body'])
+        # Acknowledge the button press while the email is being sent, not before. A failed answer
+        # (e.g. "query is too old") must not hide the result of a send that already happened.
+        success, answered = await asyncio.gather(
+            send_email(draft['subject'], draft['body']), query.answer(), return_exceptions=True
+        )
+        if isinstance(answered, Exception):
+            logger.warning("Failed to answer callback query: %s", answered)
         if success:
             await query.edit_message_text(text="✅ Email sent successfully!")
         else:
             await query.edit_message_text(text="❌ Failed to send email. Please check the server logs.")
-        
-        if 'email_draft' in context.user_data:
-            del context.user_data['email_draft']
+    else:
+        await query.answer()
+
+async def show_streamed_text(bot, chat_id: int, reply_to: int, reply, shown_text: str, text: str):
+    """Sends or edits the streamed reply so it shows text; returns the (reply, shown_text) now on screen.
+
+    Telegram errors are logged and the update is skipped, so a failed edit never discards Gemini's answer.
+    """
+    # Telegram trims trailing whitespace, so such an edit would fail with "message is not modified".
+    if not text.strip() or text.rstrip() == shown_text.rstrip():
+        return reply, shown_text
+    try:
+        if reply is None:
+            reply = await SEND_QUEUE.send(bot, chat_id, text, reply_to, coalesce=False)
+        else:
+            await reply.edit_text(text)
+    except TelegramError as e:
+        logger.warning("Failed to update the streamed reply in chat %s: %s", chat_id, e)
+        return reply, shown_text
+    return reply, text
+
+async def stream_reply(bot, chat_id: int, reply_to: int, prompt: str) -> str:
+    """Sends Gemini's response to a chat as it is generated and returns the final text.
+
+    The first chunk is sent as the reply, which is then edited at most every STREAM_EDIT_INTERVAL.
+    The returned text is cut to Telegram's message limit, so it can be resent as is.
+    """
+    loop = asyncio.get_running_loop()
+    reply, shown_text, last_edit = None, "", 0.0
+    ai_response = ""
+    try:
+        # aclosing() stops the stream's reader even if the handler is cancelled mid-stream.
+        async with aclosing(stream_gemini_response(prompt)) as chunks:
+            async for chunk in chunks:
+                ai_response += chunk
+                if loop.time() - last_edit >= STREAM_EDIT_INTERVAL:
+                    reply, shown_text = await show_streamed_text(
+                        bot, chat_id, reply_to, reply, shown_text, ai_response[:MessageLimit.MAX_TEXT_LENGTH]
+                    )
+                    last_edit = loop.time()
+    except Exception as e:
+        logger.error("Error communicating with Gemini API: %s", e)
+        ai_response = ""
+
+    ai_response = (ai_response or GEMINI_ERROR_REPLY)[:MessageLimit.MAX_TEXT_LENGTH]
+    if reply is not None and ai_response.rstrip() != shown_text.rstrip():
+        # The final edit is throttled like the others.
+        await asyncio.sleep(last_edit + STREAM_EDIT_INTERVAL - loop.time())
+    await show_streamed_text(bot, chat_id, reply_to, reply, shown_text, ai_response)
+    return ai_response
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     message_text = update.message.text
     chat_id = update.effective_chat.id
-    await context.bot.send_chat_action(chat_id=chat_id, action='typing')
-    ai_response = await generate_gemini_response(message_text)
-    await update.message.reply_text(ai_response)
+    message_id = update.message.message_id
+    # Exact cache hits are answered immediately, so they skip the typing indicator.
+    if exact_cache_get(message_text) is None:
+        send_typing(context, chat_id)
+    ai_response, embedding = await cache_lookup(message_text, chat_id)
+    if ai_response is not None:
+        await SEND_QUEUE.send(context.bot, chat_id, ai_response, message_id)
+        return
+
+    # Identical messages arriving while this one streams reuse its answer instead of calling Gemini again.
+    ai_response, shared = await coalesce_inflight(
+        inflight_key(message_text), lambda: stream_reply(context.bot, chat_id, message_id, message_text)
+    )
+    if shared:
+        await SEND_QUEUE.send(context.bot, chat_id, ai_response, message_id)
+    elif ai_response != GEMINI_ERROR_REPLY:
+        cache_store(message_text, ai_response, chat_id, await embedding if embedding else None)
 
 # --- 4. MAIN EXECUTION ---
 
-def run_bot():
-    persistence = DictPersistence()
-    application = Application.builder().token(TELEGRAM_TOKEN).persistence(persistence).build()
+COMMAND_HANDLERS = (
+    ("start", start_command),
+    ("code", code_command),
+    ("mail", mail_command),
+)
+TEXT_MESSAGE_FILTER = filters.TEXT & ~filters.COMMAND
+
+def build_application() -> Application:
+    # Persisted to disk so drafts survive restarts; stale ones are pruned by a repeating job.
+    persistence = PicklePersistence(filepath='bot_state', update_interval=60)
+    # Keep-alive HTTP/2 pools, so bursts of Bot API calls reuse one TLS connection.
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .persistence(persistence)
+        .request(HTTPXRequest(connection_pool_size=TELEGRAM_POOL_SIZE, http_version="2"))
+        .get_updates_request(HTTPXRequest(pool_timeout=30, http_version="2"))
+        # Handle updates concurrently, so one chat's Gemini call doesn't hold up everyone else's;
+        # GEMINI_SEMAPHORE still bounds how many requests are in flight.
+        .concurrent_updates(True)
+        .build()
+    )
     
-    application.add_handler(CommandHandler("start", start_command))
-    application.add_handler(CommandHandler("code", code_command))
-    application.add_handler(CommandHandler("mail", mail_command))
+    for command, callback in COMMAND_HANDLERS:
+        application.add_handler(CommandHandler(command, callback))
     application.add_handler(CallbackQueryHandler(button_handler))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    application.add_handler(MessageHandler(TEXT_MESSAGE_FILTER, handle_message))
+    application.job_queue.run_repeating(prune_email_drafts, interval=300)
+    return application
 
-    logger.info("Telegram bot is now polling for messages.")
-    application.run_polling()
+async def main():
+    application = build_application()
+    runner = web.AppRunner(build_web_app(application))
 
-if __name__ == "__main__":
-    flask_thread = threading.Thread(target=run_flask)
-    flask_thread.start()
-    
-    run_bot()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    try:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+    except NotImplementedError:
+        # Windows event loops have no signal handlers; Ctrl+C arrives as KeyboardInterrupt instead.
+        pass
 
+    async with application:
+        # The server must be listening before Telegram is told to deliver updates to it.
+        await runner.setup()
+        await web.TCPSite(runner, '0.0.0.0', PORT).start()
+        logger.info("Web server listening on port %s", PORT)
+
+        await application.start()
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                WEBHOOK_URL, secret_token=WEBHOOK_SECRET, allowed_updates=Update.ALL_TYPES
+            )
+            logger.info("Telegram bot is now receiving updates via webhook.")
+        else:
+            await application.updater.start_polling()
+            logger.info("Telegram bot is now polling for messages.")
+
+        try:
+            await stop_event.wait()
+        finally:
+            await runner.cleanup()
+            if application.updater.running:
+                await application.updater.stop()
+            await application.stop()
+
+if __name__ == "__main__":
+    try:
+        if uvloop is not None:
+            uvloop.run(main())
+        else:
+            asyncio.run(main())
+    except KeyboardInterrupt:
+        pass